@@ -0,0 +1,28 @@
+import numpy as np
+from numba import njit
+
+@njit(cache=True, fastmath=True)
+def mean_square(audio_array: np.ndarray) -> float:
+    """Mean square of a PCM buffer in one pass"""
+    n = len(audio_array)
+    if n == 0:
+        return 0.0
+
+    acc = 0.0
+    for i in range(n):
+        x = float(audio_array[i])
+        acc += x * x
+
+    return acc / n
+
+def zcr(audio_array: np.ndarray) -> float:
+    """Zero-crossing rate of int16 PCM from the XOR of adjacent sign bits"""
+    if len(audio_array) < 2:
+        return 0.0
+
+    signs = audio_array >> 15  # 0 for non-negative samples, -1 for negative
+    return np.count_nonzero(signs[1:] ^ signs[:-1]) / (len(audio_array) - 1)
+
+# Compile for the read-only int16 views (np.frombuffer) AudioProcessor passes in,
+# at import time, so the first audio chunk of a session doesn't pay for JIT compilation
+mean_square(np.frombuffer(bytes(4), dtype=np.int16))
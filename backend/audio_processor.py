@@ -1,21 +1,138 @@
 import numpy as np
-import librosa
 import webrtcvad
-import pyaudio
+import asyncio
 import logging
-import time
-from typing import Dict, Any, List
+import os
+import queue
+from collections import deque
+from concurrent.futures import Executor
+from dataclasses import dataclass
+from enum import IntEnum
+from typing import Dict, Any, Iterable, List, Optional, Tuple, Union
 import io
 import wave
+from scipy.fft import rfft, rfftfreq, next_fast_len
+
+from audio_kernels import mean_square, zcr
 
 logger = logging.getLogger(__name__)
 
+NOISE_THRESHOLD_DB = -40.0
+
+class NoiseLevel(IntEnum):
+    LOW = 0
+    MEDIUM = 1
+    HIGH = 2
+    
+    @property
+    def label(self) -> str:
+        return self.name.lower()
+
+class AudioQuality(IntEnum):
+    TOO_QUIET = 0
+    GOOD = 1
+    TOO_LOUD = 2
+    NOISY = 3
+    
+    @property
+    def label(self) -> str:
+        return self.name.lower()
+
+# dB thresholds for table-driven classification (np.searchsorted, side="right").
+# The upper quality bound is nudged so exactly -20 dB still counts as good.
+_NOISE_THRESHOLDS = np.array([-50.0, -30.0])
+_NOISE_LEVELS = (NoiseLevel.LOW, NoiseLevel.MEDIUM, NoiseLevel.HIGH)
+_QUALITY_THRESHOLDS = np.array([-60.0, np.nextafter(-20.0, np.inf)])
+_QUALITY_LEVELS = (AudioQuality.TOO_QUIET, AudioQuality.GOOD, AudioQuality.TOO_LOUD)
+
+# Every int16 sample value mapped to float32 in [-1, 1), indexed by the sample's
+# bit pattern read as uint16 (256 KiB, stays resident in L2)
+_PCM16_LUT = np.arange(-32768, 32768, dtype=np.int32).astype(np.float32) / 32768.0
+_PCM16_LUT_U = _PCM16_LUT[np.r_[32768:65536, 0:32768]]
+
+def _pcm16_to_float32(samples: np.ndarray) -> np.ndarray:
+    """Convert int16 samples to float32 with a single table gather"""
+    if not samples.flags.aligned:
+        return samples.astype(np.float32) * (1.0 / 32768.0)
+    return _PCM16_LUT_U[samples.view(np.uint16)]
+
+@dataclass
+class AudioFrameResult:
+    """Per-chunk audio analysis; converted to a dict only for the API response"""
+    __slots__ = ("db_level", "speech_detected", "noise_detected", "noise_level",
+                 "spectral_centroid", "spectral_rolloff", "zero_crossing_rate",
+                 "audio_quality", "chunk_size")
+    
+    db_level: float
+    speech_detected: bool
+    noise_detected: bool
+    noise_level: NoiseLevel
+    spectral_centroid: float
+    spectral_rolloff: float
+    zero_crossing_rate: float
+    audio_quality: AudioQuality
+    chunk_size: int
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "db_level": self.db_level,
+            "speech_detected": self.speech_detected,
+            "noise_analysis": {
+                "noise_detected": self.noise_detected,
+                "db_level": self.db_level,
+                "noise_level": self.noise_level.label,
+                "threshold_exceeded": self.noise_detected
+            },
+            "spectral_features": {
+                "spectral_centroid": self.spectral_centroid,
+                "spectral_rolloff": self.spectral_rolloff,
+                "zero_crossing_rate": self.zero_crossing_rate
+            },
+            "audio_quality": self.audio_quality.label,
+            "chunk_size": self.chunk_size,
+            "success": True
+        }
+
+class SpectralWindow:
+    """One session's audio chunks awaiting spectral analysis, and its latest features"""
+    
+    def __init__(self):
+        self.chunks = deque()
+        self.samples = 0
+        self.last_spectral = (0.0, 0.0, 0.0)
+
 class AudioProcessor:
-    def __init__(self, sample_rate: int = 16000, chunk_size: int = 320):
+    def __init__(self, sample_rate: int = 16000, chunk_size: int = 320,
+                 frame_length: int = 512, hop_length: int = 256,
+                 vad_energy_gate_db: float = -60.0, fft_workers: int = -1,
+                 spectral_window: float = 0.5):
         self.sample_rate = sample_rate
         self.chunk_size = chunk_size  # 20ms chunks for VAD
+        self.frame_length = frame_length  # FFT frame for spectral features
+        self.hop_length = hop_length
+        self.n_fft = next_fast_len(frame_length, real=True)
+        self.fft_workers = fft_workers  # -1 uses all cores
         self.vad = None
         self.audio_stream = None
+        
+        # Window and bin frequencies are fixed per instance, so build them once
+        self._hann = np.hanning(frame_length).astype(np.float32)
+        self._freqs = rfftfreq(self.n_fft, 1.0 / sample_rate)
+        
+        # VAD gate as a mean square of raw int16 samples; quieter frames skip the VAD
+        self._vad_energy_gate = (32768.0 * 10 ** (vad_energy_gate_db / 20)) ** 2
+        
+        # Each session's chunks are buffered in its SpectralWindow and analyzed once per
+        # window (in seconds); results in between carry the latest window's features
+        self._spectral_batch_samples = int(sample_rate * spectral_window)
+        
+        # Preallocated FFT input buffers (one spectral window of frames each), shared
+        # by the worker threads running process_audio_chunk_async
+        self._max_frames = 1 + 2 * self._spectral_batch_samples // hop_length
+        self._scratch_pool = queue.SimpleQueue()
+        for _ in range(os.cpu_count() or 1):
+            self._scratch_pool.put(np.empty((self._max_frames, frame_length), np.float32))
+        
         self._initialize_vad()
     
     def _initialize_vad(self):
@@ -26,91 +143,148 @@ class AudioProcessor:
         except Exception as e:
             logger.error(f"Error initializing VAD: {e}")
     
-    def decode_audio_chunk(self, audio_data: bytes) -> np.ndarray:
-        """Decode audio chunk from bytes to numpy array"""
+    def _view_pcm16(self, audio_data: bytes) -> np.ndarray:
+        """View audio chunk bytes as 16-bit PCM samples (zero-copy)"""
         try:
-            # Convert bytes to numpy array (assuming 16-bit PCM)
-            audio_array = np.frombuffer(audio_data, dtype=np.int16)
-            
-            # Convert to float32 for librosa processing
-            audio_float = audio_array.astype(np.float32) / 32768.0
-            
-            return audio_float
+            return np.frombuffer(audio_data, dtype=np.int16)
             
         except Exception as e:
             logger.error(f"Error decoding audio chunk: {e}")
-            return np.array([])
+            return np.array([], dtype=np.int16)
     
     def calculate_rms_db(self, audio_array: np.ndarray) -> float:
-        """Calculate RMS and convert to dB"""
+        """Calculate RMS of 16-bit PCM samples and convert to dB"""
         try:
             if len(audio_array) == 0:
                 return -100.0  # Very quiet
             
-            # Calculate RMS
-            rms = np.sqrt(np.mean(audio_array**2))
+            # Calculate RMS on the raw samples, scaled to [-1, 1) once at the end
+            rms = np.sqrt(mean_square(audio_array)) / 32768.0
             
             # Convert to dB, avoiding log(0)
             db = 20 * np.log10(rms + 1e-10)
             
-            return db
+            return float(db)
             
         except Exception as e:
             logger.error(f"Error calculating RMS dB: {e}")
             return -100.0
     
-    def detect_speech(self, audio_data: bytes) -> bool:
-        """Detect speech using VAD"""
+    def detect_speech(self, audio_data: Union[bytes, Iterable[bytes], np.ndarray]) -> bool:
+        """Detect speech using VAD on PCM bytes, pre-framed byte chunks, or an int16 array"""
         try:
-            if self.vad is None or len(audio_data) < self.chunk_size:
+            if self.vad is None:
+                return False
+            
+            # Get everything into one contiguous PCM buffer
+            if isinstance(audio_data, np.ndarray):
+                audio_data = np.ascontiguousarray(audio_data, dtype=np.int16).tobytes()
+            elif not isinstance(audio_data, (bytes, bytearray, memoryview)):
+                audio_data = b"".join(audio_data)
+            
+            # VAD requires specific chunk sizes, so split into whole frames
+            frame_samples = self.chunk_size // 2
+            samples = np.frombuffer(audio_data, dtype=np.int16)
+            n_frames = len(samples) // frame_samples
+            if n_frames == 0:
                 return False
+            frames = samples[:n_frames * frame_samples].reshape(n_frames, frame_samples).astype(np.int32)
             
-            # VAD requires specific chunk sizes
-            if len(audio_data) == self.chunk_size:
-                return self.vad.is_speech(audio_data, self.sample_rate)
+            # Energy pre-filter: only frames loud enough to hold speech reach the VAD
+            energies = (frames * frames).mean(axis=1)
             
-            # For larger chunks, process in segments
-            speech_detected = False
-            for i in range(0, len(audio_data) - self.chunk_size + 1, self.chunk_size):
-                chunk = audio_data[i:i + self.chunk_size]
-                if self.vad.is_speech(chunk, self.sample_rate):
-                    speech_detected = True
-                    break
+            mv = memoryview(audio_data)
+            voiced = [
+                bytes(mv[k * self.chunk_size:(k + 1) * self.chunk_size])
+                for k in np.flatnonzero(energies > self._vad_energy_gate)
+            ]
             
-            return speech_detected
+            return any(self.vad.is_speech(frame, self.sample_rate) for frame in voiced)
             
         except Exception as e:
             logger.error(f"Error detecting speech: {e}")
             return False
     
-    def analyze_spectral_features(self, audio_array: np.ndarray) -> Dict[str, float]:
-        """Analyze spectral features of audio"""
+    def _spectral_features(self, audio_array: np.ndarray) -> Tuple[float, float, float]:
+        """Spectral centroid, rolloff and zero-crossing rate of 16-bit PCM audio"""
+        if len(audio_array) == 0:
+            return 0.0, 0.0, 0.0
+        
+        # Zero crossings over the whole chunk, no framing needed
+        zero_crossing_rate = zcr(audio_array)
+        
+        # Only the FFT works on float samples
+        audio_array = _pcm16_to_float32(audio_array)
+        
+        # Frame the signal (zero-padding chunks shorter than one frame)
+        if len(audio_array) < self.frame_length:
+            audio_array = np.pad(audio_array, (0, self.frame_length - len(audio_array)))
+        frames = np.lib.stride_tricks.sliding_window_view(audio_array, self.frame_length)[::self.hop_length]
+        
+        # Window the frames into a pooled scratch buffer, allocating only if the
+        # pool is exhausted or the input is longer than one spectral window
         try:
-            if len(audio_array) == 0:
-                return {"spectral_centroid": 0.0, "spectral_rolloff": 0.0, "zero_crossing_rate": 0.0}
+            scratch = self._scratch_pool.get_nowait()
+        except queue.Empty:
+            scratch = None
+        try:
+            if scratch is not None and len(frames) <= len(scratch):
+                windowed = scratch[:len(frames)]
+            else:
+                windowed = np.empty((len(frames), self.frame_length), np.float32)
+            np.multiply(frames, self._hann, out=windowed)
             
-            # Calculate spectral features
-            spectral_centroid = librosa.feature.spectral_centroid(y=audio_array, sr=self.sample_rate)[0]
-            spectral_rolloff = librosa.feature.spectral_rolloff(y=audio_array, sr=self.sample_rate)[0]
-            zero_crossing_rate = librosa.feature.zero_crossing_rate(audio_array)[0]
+            # One rFFT shared by centroid and rolloff
+            mag = np.abs(rfft(windowed, n=self.n_fft, axis=-1, workers=self.fft_workers))
+        finally:
+            if scratch is not None:
+                self._scratch_pool.put(scratch)
+        total = mag.sum(axis=1)
+        
+        spectral_centroid = (mag @ self._freqs) / (total + 1e-10)
+        
+        # Rolloff: lowest bin holding 85% of the frame's spectral energy
+        cumulative = np.cumsum(mag, axis=1)
+        rolloff_bins = (cumulative < 0.85 * total[:, None]).sum(axis=1)
+        spectral_rolloff = self._freqs[np.minimum(rolloff_bins, len(self._freqs) - 1)]
+        
+        return float(np.mean(spectral_centroid)), float(np.mean(spectral_rolloff)), float(zero_crossing_rate)
+    
+    def analyze_spectral_features(self, audio_array: np.ndarray) -> Dict[str, float]:
+        """Analyze spectral features of 16-bit PCM audio"""
+        try:
+            centroid, rolloff, zero_crossing_rate = self._spectral_features(audio_array)
             
             return {
-                "spectral_centroid": float(np.mean(spectral_centroid)),
-                "spectral_rolloff": float(np.mean(spectral_rolloff)),
-                "zero_crossing_rate": float(np.mean(zero_crossing_rate))
+                "spectral_centroid": centroid,
+                "spectral_rolloff": rolloff,
+                "zero_crossing_rate": zero_crossing_rate
             }
             
         except Exception as e:
             logger.error(f"Error analyzing spectral features: {e}")
             return {"spectral_centroid": 0.0, "spectral_rolloff": 0.0, "zero_crossing_rate": 0.0}
     
-    def detect_background_noise(self, audio_array: np.ndarray, threshold_db: float = -40.0) -> Dict[str, Any]:
+    def _noise_level(self, db_level: float) -> NoiseLevel:
+        """Classify a dB level into a noise level"""
+        return _NOISE_LEVELS[np.searchsorted(_NOISE_THRESHOLDS, db_level, side="right")]
+    
+    def _audio_quality(self, db_level: float, noise_detected: bool) -> AudioQuality:
+        """Classify a dB level into an audio quality"""
+        quality = _QUALITY_LEVELS[np.searchsorted(_QUALITY_THRESHOLDS, db_level, side="right")]
+        if quality == AudioQuality.GOOD and noise_detected:
+            return AudioQuality.NOISY
+        return quality
+    
+    def detect_background_noise(self, audio_array: np.ndarray, threshold_db: float = NOISE_THRESHOLD_DB,
+                                db_level: float = None) -> Dict[str, Any]:
         """Detect background noise levels"""
         try:
-            db_level = self.calculate_rms_db(audio_array)
+            if db_level is None:
+                db_level = self.calculate_rms_db(audio_array)
             
             noise_detected = db_level > threshold_db
-            noise_level = "low" if db_level < -50 else "medium" if db_level < -30 else "high"
+            noise_level = self._noise_level(db_level).label
             
             return {
                 "noise_detected": noise_detected,
@@ -128,14 +302,32 @@ class AudioProcessor:
                 "threshold_exceeded": False
             }
     
-    def process_audio_chunk(self, audio_data: bytes) -> Dict[str, Any]:
-        """Process a single audio chunk for proctoring analysis"""
+    def _update_spectral_features(self, audio_array: np.ndarray,
+                                  window: SpectralWindow) -> Tuple[float, float, float]:
+        """Buffer a chunk and re-run the spectral analysis once a full window is available"""
+        window.chunks.append(audio_array)
+        window.samples += len(audio_array)
+        
+        if window.samples < self._spectral_batch_samples:
+            return window.last_spectral
+        
+        batch = np.concatenate(window.chunks)
+        window.chunks.clear()
+        window.samples = 0
+        
+        window.last_spectral = self._spectral_features(batch)
+        return window.last_spectral
+    
+    def process_audio_chunk(self, audio_data: bytes,
+                            spectral_window: Optional[SpectralWindow] = None) -> Optional[AudioFrameResult]:
+        """Process a single audio chunk; spectral features are batched in the session's window if given"""
         try:
-            # Decode audio
-            audio_array = self.decode_audio_chunk(audio_data)
+            # View audio as int16 samples; nothing below needs a float copy
+            audio_array = self._view_pcm16(audio_data)
             
             if len(audio_array) == 0:
-                return {"error": "Invalid audio data", "success": False}
+                logger.warning("Invalid audio data")
+                return None
             
             # Calculate basic metrics
             db_level = self.calculate_rms_db(audio_array)
@@ -144,40 +336,43 @@ class AudioProcessor:
             speech_detected = self.detect_speech(audio_data)
             
             # Analyze noise
-            noise_analysis = self.detect_background_noise(audio_array)
-            
-            # Analyze spectral features
-            spectral_features = self.analyze_spectral_features(audio_array)
+            noise_detected = db_level > NOISE_THRESHOLD_DB
             
-            # Determine audio quality
-            audio_quality = "good"
-            if db_level < -60:
-                audio_quality = "too_quiet"
-            elif db_level > -20:
-                audio_quality = "too_loud"
-            elif noise_analysis["threshold_exceeded"]:
-                audio_quality = "noisy"
+            # Analyze spectral features (batched across the session's chunks)
+            if spectral_window is not None:
+                spectral = self._update_spectral_features(audio_array, spectral_window)
+            else:
+                spectral = self._spectral_features(audio_array)
+            centroid, rolloff, zero_crossing_rate = spectral
             
-            result = {
-                "db_level": db_level,
-                "speech_detected": speech_detected,
-                "noise_analysis": noise_analysis,
-                "spectral_features": spectral_features,
-                "audio_quality": audio_quality,
-                "chunk_size": len(audio_data),
-                "processing_time": time.time(),
-                "success": True
-            }
-            
-            return result
+            return AudioFrameResult(
+                db_level=db_level,
+                speech_detected=speech_detected,
+                noise_detected=noise_detected,
+                noise_level=self._noise_level(db_level),
+                spectral_centroid=centroid,
+                spectral_rolloff=rolloff,
+                zero_crossing_rate=zero_crossing_rate,
+                audio_quality=self._audio_quality(db_level, noise_detected),
+                chunk_size=len(audio_data)
+            )
             
         except Exception as e:
             logger.error(f"Error processing audio chunk: {e}")
-            return {"error": str(e), "success": False}
+            return None
+    
+    async def process_audio_chunk_async(self, audio_data: bytes, executor: Optional[Executor] = None,
+                                        spectral_window: Optional[SpectralWindow] = None) -> Optional[AudioFrameResult]:
+        """Process an audio chunk on a worker thread, keeping the event loop free"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, self.process_audio_chunk, audio_data, spectral_window)
     
     def setup_audio_stream(self, device_index: int = None) -> bool:
         """Setup PyAudio stream for real-time audio capture"""
         try:
+            # Imported here so processes that only analyze chunks never load PortAudio
+            import pyaudio
+            
             self.audio_stream = pyaudio.PyAudio()
             
             stream = self.audio_stream.open(
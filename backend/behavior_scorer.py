@@ -1,18 +1,53 @@
 import time
+import itertools
 import logging
+import numpy as np
+from collections import deque
 from datetime import datetime
-from typing import Dict, Any, List
-from enum import Enum
+from typing import Dict, Any, List, Tuple
+from enum import Enum, IntEnum
 
 logger = logging.getLogger(__name__)
 
-class ViolationType(Enum):
-    FACE_ABSENT = "face_absent"
-    MULTIPLE_FACES = "multiple_faces"
-    NOISE_DETECTED = "noise_detected"
-    SPEECH_DETECTED = "speech_detected"
-    TAB_SWITCH = "tab_switch"
-    HEAD_TURN = "head_turn"
+# Offset from time.monotonic_ns() to the Unix epoch, for formatting timestamps
+_MONOTONIC_EPOCH_OFFSET_NS = time.time_ns() - time.monotonic_ns()
+
+PENALTY_COOLDOWN_NS = 5_000_000_000  # 5 seconds cooldown between penalties
+VIOLATION_HISTORY = 10_000  # violation records kept per session (ring buffer)
+RECENT_VIOLATIONS = 256  # violation records shown in the detailed report
+
+def _ns_to_datetime(ts_ns: int) -> datetime:
+    """Convert a time.monotonic_ns() timestamp to a naive UTC datetime"""
+    return datetime.utcfromtimestamp((ts_ns + _MONOTONIC_EPOCH_OFFSET_NS) / 1e9)
+
+def _ns_to_iso(ts_ns: int) -> str:
+    """Format a time.monotonic_ns() timestamp as an ISO 8601 UTC string"""
+    return _ns_to_datetime(ts_ns).isoformat()
+
+def stored_violation(violation: Dict[str, Any]) -> Dict[str, Any]:
+    """Violation record for the database, with the process-local ts_ns replaced by a UTC timestamp"""
+    record = dict(violation)
+    record["timestamp"] = _ns_to_datetime(record.pop("ts_ns"))
+    return record
+
+def reported_violation(violation: Dict[str, Any]) -> Dict[str, Any]:
+    """Violation record for API and websocket responses, with ts_ns replaced by an ISO 8601 UTC timestamp"""
+    record = dict(violation)
+    record["timestamp"] = _ns_to_iso(record.pop("ts_ns"))
+    return record
+
+class ViolationType(IntEnum):
+    # Values index the per-type counter, penalty and threshold arrays
+    FACE_ABSENT = 0
+    MULTIPLE_FACES = 1
+    NOISE_DETECTED = 2
+    SPEECH_DETECTED = 3
+    TAB_SWITCH = 4
+    HEAD_TURN = 5
+    
+    @property
+    def label(self) -> str:
+        return self.name.lower()
 
 class SeverityLevel(Enum):
     LOW = "low"
@@ -20,165 +55,211 @@ class SeverityLevel(Enum):
     HIGH = "high"
     CRITICAL = "critical"
 
+# Integer codes and labels for the columnar violation store
+_VIOLATION_LABELS = tuple(violation_type.label for violation_type in ViolationType)
+_SEVERITY_LABELS = tuple(severity.value for severity in SeverityLevel)
+_SEVERITY_CODES = {severity: i for i, severity in enumerate(SeverityLevel)}
+
 class BehaviorScorer:
     def __init__(self):
         self.base_score = 100
         self.current_score = 100
-        self.violations = []
-        self.violation_counts = {
-            ViolationType.FACE_ABSENT: 0,
-            ViolationType.MULTIPLE_FACES: 0,
-            ViolationType.NOISE_DETECTED: 0,
-            ViolationType.SPEECH_DETECTED: 0,
-            ViolationType.TAB_SWITCH: 0,
-            ViolationType.HEAD_TURN: 0
-        }
-        self.violation_penalties = {
-            ViolationType.FACE_ABSENT: 5,
-            ViolationType.MULTIPLE_FACES: 10,
-            ViolationType.NOISE_DETECTED: 3,
-            ViolationType.SPEECH_DETECTED: 5,
-            ViolationType.TAB_SWITCH: 5,
-            ViolationType.HEAD_TURN: 3
-        }
-        self.thresholds = {
-            ViolationType.FACE_ABSENT: 3,  # seconds
-            ViolationType.MULTIPLE_FACES: 5,  # consecutive detections
-            ViolationType.NOISE_DETECTED: 3,  # consecutive detections
-            ViolationType.SPEECH_DETECTED: 10,  # consecutive detections
-            ViolationType.TAB_SWITCH: 1,  # immediate penalty
-            ViolationType.HEAD_TURN: 3  # consecutive detections
-        }
-        self.last_violation_times = {}
+        self.violations = deque(maxlen=VIOLATION_HISTORY)  # most recent records only
+        # Running totals per (ViolationType, SeverityLevel) over the whole session
+        self._count_by_type_sev = np.zeros((len(ViolationType), len(SeverityLevel)), np.int32)
+        # Per-type state, indexed by ViolationType value
+        self._counts = np.zeros(len(ViolationType), np.int32)
+        self._penalties = np.array([
+            5,   # FACE_ABSENT
+            10,  # MULTIPLE_FACES
+            3,   # NOISE_DETECTED
+            5,   # SPEECH_DETECTED
+            5,   # TAB_SWITCH
+            3    # HEAD_TURN
+        ], np.int32)
+        self._thresholds = np.array([
+            3,   # FACE_ABSENT: seconds
+            5,   # MULTIPLE_FACES: consecutive detections
+            3,   # NOISE_DETECTED: consecutive detections
+            10,  # SPEECH_DETECTED: consecutive detections
+            1,   # TAB_SWITCH: immediate penalty
+            3    # HEAD_TURN: consecutive detections
+        ], np.int32)
+        self._last_t = np.full(len(ViolationType), -np.inf)  # last penalty time per type, ns
+        self._reset_violation_columns()
+    
+    def _reset_violation_columns(self):
+        """Allocate the columnar (struct-of-arrays) ring mirroring self.violations"""
+        self._v_types = np.empty(VIOLATION_HISTORY, np.int8)
+        self._v_ts = np.empty(VIOLATION_HISTORY, np.int64)  # time.monotonic_ns()
+        self._v_sev = np.empty(VIOLATION_HISTORY, np.int8)
+        self._v_penalty = np.empty(VIOLATION_HISTORY, np.bool_)
+        self._v_n = 0  # rows ever written; the next row goes to _v_n % VIOLATION_HISTORY
+    
+    def _append_violation_row(self, violation_type: ViolationType, ts_ns: int,
+                              severity_code: int, penalty_applied: bool):
+        """Write a violation into the columnar ring, overwriting the oldest row when full"""
+        row = self._v_n % VIOLATION_HISTORY
+        self._v_types[row] = violation_type
+        self._v_ts[row] = ts_ns
+        self._v_sev[row] = severity_code
+        self._v_penalty[row] = penalty_applied
+        self._v_n += 1
     
     def reset_scores(self):
         """Reset all scores and violations for a new test session"""
         self.current_score = self.base_score
-        self.violations = []
-        self.violation_counts = {violation_type: 0 for violation_type in ViolationType}
-        self.last_violation_times = {}
+        self.violations.clear()
+        self._count_by_type_sev[:] = 0
+        self._counts[:] = 0
+        self._last_t[:] = -np.inf
+        self._reset_violation_columns()
         logger.info("Behavior scores reset for new test session")
     
-    def _should_penalize(self, violation_type: ViolationType, current_time: float) -> bool:
-        """Check if enough time has passed since last violation to apply penalty"""
-        if violation_type not in self.last_violation_times:
-            return True
+    def apply_batch(self, types: np.ndarray, ts_ns: np.ndarray):
+        """Count a batch of violations and apply due penalties across all types at once
         
-        time_since_last = current_time - self.last_violation_times[violation_type]
-        cooldown_period = 5.0  # 5 seconds cooldown between penalties
+        Returns the per-type counts before any reset and the mask of types penalized.
+        """
+        np.add.at(self._counts, types, 1)
+        ts_ns_latest = ts_ns.max()
         
-        return time_since_last > cooldown_period
-    
-    def add_violation(self, violation_type: ViolationType, severity: SeverityLevel = SeverityLevel.MEDIUM, 
-                     additional_data: Dict[str, Any] = None) -> Dict[str, Any]:
-        """Add a violation and update behavior score"""
-        current_time = time.time()
+        # Only types present in this batch are eligible; the rest keep waiting
+        in_batch = np.zeros(len(ViolationType), np.bool_)
+        in_batch[types] = True
+        ready = in_batch & (self._counts >= self._thresholds) & \
+            ((ts_ns_latest - self._last_t) > PENALTY_COOLDOWN_NS)
         
-        # Increment violation count
-        self.violation_counts[violation_type] += 1
+        counts = self._counts.copy()
+        fire = np.flatnonzero(ready)
+        if len(fire):
+            self.current_score = max(0, self.current_score - int(self._penalties[fire].sum()))
+            
+            # Reset count after penalty
+            self._counts[fire] = 0
+            self._last_t[fire] = ts_ns_latest
         
-        # Check if we should apply penalty
-        should_penalize = self._should_penalize(violation_type, current_time)
+        return counts, ready
+    
+    def _add_violations(self, pending: List[Tuple[ViolationType, SeverityLevel, Dict[str, Any]]]) -> List[Dict[str, Any]]:
+        """Record (type, severity, additional_data) violations with a single apply_batch call"""
+        if not pending:
+            return []
         
-        violation_data = {
-            "type": violation_type.value,
-            "timestamp": datetime.utcnow(),
-            "severity": severity.value,
-            "count": self.violation_counts[violation_type],
-            "penalty_applied": False,
-            "additional_data": additional_data or {}
-        }
+        ts_ns = time.monotonic_ns()
+        types = np.fromiter((violation_type for violation_type, _, _ in pending), np.int8, len(pending))
+        counts, fired = self.apply_batch(types, np.full(len(pending), ts_ns, np.int64))
         
-        # Apply penalty if threshold exceeded and cooldown passed
-        if (self.violation_counts[violation_type] >= self.thresholds[violation_type] and 
-            should_penalize):
-            
-            penalty = self.violation_penalties[violation_type]
-            self.current_score = max(0, self.current_score - penalty)
-            violation_data["penalty_applied"] = True
-            violation_data["penalty_amount"] = penalty
+        # A type can appear several times in one batch: each record gets its running
+        # count, and a fired penalty goes to the type's last record only
+        remaining = np.bincount(types, minlength=len(ViolationType)).tolist()
+        
+        violations_added = []
+        for violation_type, severity, additional_data in pending:
+            remaining[violation_type] -= 1
+            penalty_applied = bool(fired[violation_type]) and remaining[violation_type] == 0
+            violation_data = {
+                "type": violation_type.label,
+                "ts_ns": ts_ns,
+                "severity": severity.value,
+                "count": int(counts[violation_type]) - remaining[violation_type],
+                "penalty_applied": penalty_applied,
+                "additional_data": additional_data or {}
+            }
             
-            # Reset count after penalty
-            self.violation_counts[violation_type] = 0
-            self.last_violation_times[violation_type] = current_time
+            if penalty_applied:
+                penalty = int(self._penalties[violation_type])
+                violation_data["penalty_amount"] = penalty
+                logger.warning(f"Violation penalty applied: {violation_type.label} (-{penalty} points)")
             
-            logger.warning(f"Violation penalty applied: {violation_type.value} (-{penalty} points)")
+            # Update the running totals and the bounded recent history
+            severity_code = _SEVERITY_CODES[severity]
+            self._count_by_type_sev[violation_type, severity_code] += 1
+            self.violations.append(violation_data)
+            self._append_violation_row(violation_type, ts_ns, severity_code, penalty_applied)
+            violations_added.append(violation_data)
         
-        # Add to violations list
-        self.violations.append(violation_data)
-        
-        return violation_data
+        return violations_added
+    
+    def add_violation(self, violation_type: ViolationType, severity: SeverityLevel = SeverityLevel.MEDIUM, 
+                     additional_data: Dict[str, Any] = None) -> Dict[str, Any]:
+        """Add a violation and update behavior score"""
+        return self._add_violations([(violation_type, severity, additional_data)])[0]
     
     def process_video_analysis(self, video_result: Dict[str, Any]) -> List[Dict[str, Any]]:
         """Process video analysis results and add violations if needed"""
-        violations_added = []
+        pending = []
         
         try:
+            # The common case, one steady face, has nothing to record
+            movement_analysis = video_result.get("movement_analysis", {})
+            if video_result.get("face_count") == 1 and not movement_analysis.get("head_turn_detected", False):
+                return pending
+            
             # Check for face absence
             if not video_result.get("face_present", True):
-                violation = self.add_violation(
+                pending.append((
                     ViolationType.FACE_ABSENT,
                     SeverityLevel.HIGH,
                     {"face_count": video_result.get("face_count", 0)}
-                )
-                violations_added.append(violation)
+                ))
             
             # Check for multiple faces
             face_count = video_result.get("face_count", 0)
             if face_count > 1:
-                violation = self.add_violation(
+                pending.append((
                     ViolationType.MULTIPLE_FACES,
                     SeverityLevel.CRITICAL,
                     {"face_count": face_count}
-                )
-                violations_added.append(violation)
+                ))
             
             # Check for head turning
-            movement_analysis = video_result.get("movement_analysis", {})
             if movement_analysis.get("head_turn_detected", False):
-                violation = self.add_violation(
+                pending.append((
                     ViolationType.HEAD_TURN,
                     SeverityLevel.MEDIUM,
                     {"movement_score": movement_analysis.get("movement_score", 0)}
-                )
-                violations_added.append(violation)
+                ))
+            
+            return self._add_violations(pending)
             
         except Exception as e:
             logger.error(f"Error processing video analysis: {e}")
         
-        return violations_added
+        return []
     
-    def process_audio_analysis(self, audio_result: Dict[str, Any]) -> List[Dict[str, Any]]:
-        """Process audio analysis results and add violations if needed"""
-        violations_added = []
+    def process_audio_analysis(self, audio_result) -> List[Dict[str, Any]]:
+        """Process one AudioFrameResult, or a batch of them, and add violations if needed"""
+        pending = []
+        audio_results = audio_result if isinstance(audio_result, (list, tuple)) else (audio_result,)
         
         try:
-            # Check for noise violations
-            noise_analysis = audio_result.get("noise_analysis", {})
-            if noise_analysis.get("threshold_exceeded", False):
-                violation = self.add_violation(
-                    ViolationType.NOISE_DETECTED,
-                    SeverityLevel.MEDIUM,
-                    {
-                        "db_level": noise_analysis.get("db_level", 0),
-                        "noise_level": noise_analysis.get("noise_level", "unknown")
-                    }
-                )
-                violations_added.append(violation)
+            for audio_result in audio_results:
+                # Check for noise violations
+                if audio_result.noise_detected:
+                    pending.append((
+                        ViolationType.NOISE_DETECTED,
+                        SeverityLevel.MEDIUM,
+                        {
+                            "db_level": audio_result.db_level,
+                            "noise_level": audio_result.noise_level.label
+                        }
+                    ))
+                
+                # Check for speech violations
+                if audio_result.speech_detected:
+                    pending.append((
+                        ViolationType.SPEECH_DETECTED,
+                        SeverityLevel.MEDIUM,
+                        {"audio_quality": audio_result.audio_quality.label}
+                    ))
             
-            # Check for speech violations
-            if audio_result.get("speech_detected", False):
-                violation = self.add_violation(
-                    ViolationType.SPEECH_DETECTED,
-                    SeverityLevel.MEDIUM,
-                    {"audio_quality": audio_result.get("audio_quality", "unknown")}
-                )
-                violations_added.append(violation)
+            return self._add_violations(pending)
             
         except Exception as e:
             logger.error(f"Error processing audio analysis: {e}")
         
-        return violations_added
+        return []
     
     def add_tab_switch_violation(self) -> Dict[str, Any]:
         """Add tab switch violation (immediate penalty)"""
@@ -196,23 +277,13 @@ class BehaviorScorer:
     def get_violation_summary(self) -> Dict[str, Any]:
         """Get summary of all violations"""
         return {
-            "total_violations": len(self.violations),
-            "violation_counts": {k.value: v for k, v in self.violation_counts.items()},
+            "total_violations": int(self._count_by_type_sev.sum()),
+            "violation_counts": dict(zip(_VIOLATION_LABELS, self._counts.tolist())),
             "current_score": self.current_score,
             "score_deduction": self.base_score - self.current_score,
-            "violations_by_type": self._group_violations_by_type()
+            "violations_by_type": dict(zip(_VIOLATION_LABELS, self._count_by_type_sev.sum(axis=1).tolist()))
         }
     
-    def _group_violations_by_type(self) -> Dict[str, List[Dict[str, Any]]]:
-        """Group violations by type"""
-        grouped = {}
-        for violation in self.violations:
-            violation_type = violation["type"]
-            if violation_type not in grouped:
-                grouped[violation_type] = []
-            grouped[violation_type].append(violation)
-        return grouped
-    
     def calculate_final_score(self, test_score: float, behavior_weight: float = 0.4, 
                            test_weight: float = 0.6) -> Dict[str, Any]:
         """Calculate final score combining test score and behavior score"""
@@ -255,34 +326,29 @@ class BehaviorScorer:
     
     def get_detailed_report(self) -> Dict[str, Any]:
         """Get detailed violation report"""
+        # Timestamps are formatted on the way out, where clients need strings
+        recent = itertools.islice(reversed(self.violations), RECENT_VIOLATIONS)
+        records = [reported_violation(violation) for violation in recent][::-1]
+        
         return {
             "session_summary": self.get_violation_summary(),
-            "all_violations": self.violations,
-            "violations_by_severity": self._group_violations_by_severity(),
+            "recent_violations": records,
+            "violations_by_severity": dict(zip(_SEVERITY_LABELS, self._count_by_type_sev.sum(axis=0).tolist())),
             "timeline": self._create_violation_timeline()
         }
     
-    def _group_violations_by_severity(self) -> Dict[str, List[Dict[str, Any]]]:
-        """Group violations by severity level"""
-        grouped = {}
-        for violation in self.violations:
-            severity = violation["severity"]
-            if severity not in grouped:
-                grouped[severity] = []
-            grouped[severity].append(violation)
-        return grouped
-    
     def _create_violation_timeline(self) -> List[Dict[str, Any]]:
-        """Create chronological timeline of violations"""
-        timeline = []
-        for violation in self.violations:
-            timeline.append({
-                "timestamp": violation["timestamp"],
-                "type": violation["type"],
-                "severity": violation["severity"],
-                "penalty_applied": violation.get("penalty_applied", False)
-            })
+        """Create chronological timeline of recent violations"""
+        kept = min(self._v_n, RECENT_VIOLATIONS)
+        rows = (np.arange(kept) + self._v_n - kept) % VIOLATION_HISTORY
+        rows = rows[np.argsort(self._v_ts[rows], kind="stable")]
         
-        # Sort by timestamp
-        timeline.sort(key=lambda x: x["timestamp"])
-        return timeline
+        return [
+            {
+                "timestamp": _ns_to_iso(int(self._v_ts[row])),
+                "type": _VIOLATION_LABELS[self._v_types[row]],
+                "severity": _SEVERITY_LABELS[self._v_sev[row]],
+                "penalty_applied": bool(self._v_penalty[row])
+            }
+            for row in rows
+        ]
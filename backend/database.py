@@ -1,47 +1,90 @@
 import os
+import asyncio
+from datetime import datetime
 from motor.motor_asyncio import AsyncIOMotorClient
 from pymongo import MongoClient
 import logging
+from cachetools import TTLCache
+from typing import List
 
 logger = logging.getLogger(__name__)
 
+# Test result fields returned to clients (the embedded violations list is left out)
+TEST_RESULT_PROJECTION = {
+    "_id": 0,
+    "course_id": 1,
+    "difficulty": 1,
+    "test_score": 1,
+    "behavior_score": 1,
+    "final_score": 1,
+    "certificate_status": 1,
+    "submitted_at": 1
+}
+
+VIOLATION_PROJECTION = {"_id": 0, "violation": 1, "logged_at": 1}
+
+_MISS = object()  # certificate cache sentinel; a cached status can itself be None
+
 class DatabaseManager:
     def __init__(self, mongodb_url: str = "mongodb://localhost:27017"):
         self.client = AsyncIOMotorClient(mongodb_url)
         self.db = self.client.learnquest_proctoring
-        self._ensure_indexes()
+        
+        # Certificate status only changes when a test is submitted; cache it per
+        # (user_id, course_id) and invalidate in save_test_result
+        self._cert_cache = TTLCache(maxsize=10_000, ttl=30)
+        # (user_id, course_id) -> [lookups in flight, saves seen meanwhile], kept only while a
+        # lookup runs, so one that raced save_test_result doesn't cache the old status
+        self._cert_inflight = {}
     
-    def _ensure_indexes(self):
-        """Create necessary database indexes"""
+    async def ensure_ready(self):
+        """Create necessary database indexes (idempotent; awaited on app startup)"""
         try:
             # Create indexes for better performance
-            self.db.violations.create_index([("user_id", 1), ("course_id", 1)])
-            self.db.test_results.create_index([("user_id", 1)])
-            self.db.test_results.create_index([("course_id", 1)])
-            self.db.test_results.create_index([("submitted_at", -1)])
+            # (compound indexes include the sort key so queries skip an in-memory SORT)
+            await asyncio.gather(
+                self.db.violations.create_index([("user_id", 1), ("course_id", 1), ("logged_at", -1)]),
+                self.db.test_results.create_index([("user_id", 1), ("submitted_at", -1)]),
+                self.db.test_results.create_index([("course_id", 1)])
+            )
             logger.info("Database indexes created successfully")
         except Exception as e:
             logger.error(f"Error creating database indexes: {e}")
     
     async def log_violation(self, user_id: str, course_id: str, violation: dict):
-        """Log a violation to the database"""
+        """Log a single violation to the database"""
+        return await self.log_violations_bulk(user_id, course_id, [violation])
+    
+    async def log_violations_bulk(self, user_id: str, course_id: str, violations: List[dict]):
+        """Write a batch of violations for one session in a single insert_many"""
+        if not violations:
+            return True
+        
         try:
-            violation_doc = {
-                "user_id": user_id,
-                "course_id": course_id,
-                "violation": violation,
-                "logged_at": violation.get("timestamp")
-            }
-            await self.db.violations.insert_one(violation_doc)
+            logged_at = datetime.utcnow()
+            await self.db.violations.insert_many([
+                {
+                    "user_id": user_id,
+                    "course_id": course_id,
+                    "violation": violation,
+                    "logged_at": logged_at
+                }
+                for violation in violations
+            ], ordered=False)
             return True
         except Exception as e:
-            logger.error(f"Error logging violation: {e}")
+            logger.error(f"Error logging {len(violations)} violations: {e}")
             return False
     
     async def save_test_result(self, test_result: dict):
         """Save test result to the database"""
         try:
             await self.db.test_results.insert_one(test_result)
+            key = (test_result.get("user_id"), test_result.get("course_id"))
+            inflight = self._cert_inflight.get(key)
+            if inflight is not None:
+                inflight[1] += 1
+            self._cert_cache.pop(key, None)
             return True
         except Exception as e:
             logger.error(f"Error saving test result: {e}")
@@ -51,7 +94,8 @@ class DatabaseManager:
         """Get test results for a user"""
         try:
             results = await self.db.test_results.find(
-                {"user_id": user_id}
+                {"user_id": user_id},
+                projection=TEST_RESULT_PROJECTION
             ).sort("submitted_at", -1).limit(limit).to_list(length=limit)
             return results
         except Exception as e:
@@ -64,7 +108,7 @@ class DatabaseManager:
             violations = await self.db.violations.find({
                 "user_id": user_id,
                 "course_id": course_id
-            }).sort("logged_at", -1).limit(limit).to_list(length=limit)
+            }, projection=VIOLATION_PROJECTION).sort("logged_at", -1).limit(limit).to_list(length=limit)
             return violations
         except Exception as e:
             logger.error(f"Error fetching violations: {e}")
@@ -72,22 +116,38 @@ class DatabaseManager:
     
     async def get_certificate_status(self, user_id: str, course_id: str):
         """Get certificate status for a user and course"""
+        key = (user_id, course_id)
+        status = self._cert_cache.get(key, _MISS)
+        if status is not _MISS:
+            return status
+        
+        inflight = self._cert_inflight.setdefault(key, [0, 0])
+        inflight[0] += 1
+        saves_seen = inflight[1]
         try:
             result = await self.db.test_results.find_one({
                 "user_id": user_id,
                 "course_id": course_id
             }, sort=[("submitted_at", -1)])
             
+            status = None
             if result:
-                return {
+                status = {
                     "certificate_status": result.get("certificate_status"),
                     "final_score": result.get("final_score"),
                     "submitted_at": result.get("submitted_at")
                 }
-            return None
+            
+            if inflight[1] == saves_seen:
+                self._cert_cache[key] = status
+            return status
         except Exception as e:
             logger.error(f"Error fetching certificate status: {e}")
             return None
+        finally:
+            inflight[0] -= 1
+            if inflight[0] == 0:
+                del self._cert_inflight[key]
     
     async def close(self):
         """Close database connection"""
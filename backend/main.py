@@ -1,10 +1,11 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-import json
+from fastapi.responses import ORJSONResponse
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import logging
+import os
 from typing import List, Dict, Any
 import time
 import base64
@@ -12,15 +13,16 @@ import base64
 # Import our custom modules
 from models import TestSubmission, IdentityVerification, ProctoringResponse
 from database import db_manager
-from video_processor import VideoProcessor
+from video_processor import VideoProcessor, FrameBatcher
 from audio_processor import AudioProcessor
-from behavior_scorer import BehaviorScorer
+from behavior_scorer import BehaviorScorer, stored_violation
+from proctoring_session import ProctoringSession
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="LearnQuest Proctoring API", version="1.0.0")
+app = FastAPI(title="LearnQuest Proctoring API", version="1.0.0", default_response_class=ORJSONResponse)
 
 # CORS middleware
 app.add_middleware(
@@ -33,17 +35,26 @@ app.add_middleware(
 
 # Global instances
 video_processor = None
+frame_batcher = None
 audio_processor = None
 behavior_scorer = None
+cpu_pool = None  # JPEG decode and audio analysis; both release the GIL in native code
 
 @app.on_event("startup")
 async def startup_event():
     """Initialize models and services on startup"""
-    global video_processor, audio_processor, behavior_scorer
+    global video_processor, frame_batcher, audio_processor, behavior_scorer, cpu_pool
     
     try:
+        # Make sure indexes exist before the first query
+        await db_manager.ensure_ready()
+        
+        cpu_pool = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix="cpu")
+        
         # Initialize processors
-        video_processor = VideoProcessor()
+        # With YOLO_SERVICE_ADDRESS set, workers share one model in yolo_service.py
+        video_processor = VideoProcessor(os.getenv("YOLO_SERVICE_ADDRESS"))
+        frame_batcher = FrameBatcher(video_processor)
         audio_processor = AudioProcessor()
         behavior_scorer = BehaviorScorer()
         
@@ -51,22 +62,28 @@ async def startup_event():
         
     except Exception as e:
         logger.error(f"Error initializing processors: {e}")
+        raise  # fail startup rather than serve sessions without working detection
 
 @app.on_event("shutdown")
 async def shutdown_event():
     """Cleanup on shutdown"""
     try:
+        if frame_batcher:
+            await frame_batcher.close()
         if video_processor:
             video_processor.cleanup()
         if audio_processor:
             audio_processor.cleanup()
+        if cpu_pool:
+            cpu_pool.shutdown(wait=False)
         await db_manager.close()
         logger.info("Cleanup completed successfully")
     except Exception as e:
         logger.error(f"Error during shutdown: {e}")
 
 @app.websocket("/ws/proctoring/{user_id}/{course_id}")
-async def websocket_proctoring(websocket: WebSocket, user_id: str, course_id: str):
+async def websocket_proctoring(websocket: WebSocket, user_id: str, course_id: str,
+                               debug: bool = False, trace: bool = False):
     """WebSocket endpoint for real-time proctoring"""
     await websocket.accept()
     logger.info(f"Proctoring session started for user {user_id}, course {course_id}")
@@ -74,65 +91,11 @@ async def websocket_proctoring(websocket: WebSocket, user_id: str, course_id: st
     # Reset behavior scorer for new session
     behavior_scorer.reset_scores()
     
+    session = ProctoringSession(websocket, user_id, course_id, video_processor, frame_batcher,
+                                audio_processor, behavior_scorer, cpu_pool, debug=debug, trace=trace)
     try:
-        while True:
-            # Receive data from frontend
-            data = await websocket.receive_text()
-            message = json.loads(data)
-            
-            if message["type"] == "video_frame":
-                # Process video frame
-                if video_processor:
-                    result = video_processor.process_frame(message["data"])
-                    
-                    if result.get("success", False):
-                        # Process violations
-                        violations = behavior_scorer.process_video_analysis(result)
-                        
-                        # Log violations to database
-                        for violation in violations:
-                            await db_manager.log_violation(user_id, course_id, violation)
-                    
-                    # Send response back to frontend
-                    await websocket.send_text(json.dumps({
-                        "type": "video_result",
-                        "result": result,
-                        "behavior_score": behavior_scorer.get_current_score()
-                    }))
-                
-            elif message["type"] == "audio_chunk":
-                # Process audio chunk
-                if audio_processor:
-                    # Convert base64 audio data to bytes
-                    audio_bytes = base64.b64decode(message["data"])
-                    result = audio_processor.process_audio_chunk(audio_bytes)
-                    
-                    if result.get("success", False):
-                        # Process violations
-                        violations = behavior_scorer.process_audio_analysis(result)
-                        
-                        # Log violations to database
-                        for violation in violations:
-                            await db_manager.log_violation(user_id, course_id, violation)
-                    
-                    # Send response back to frontend
-                    await websocket.send_text(json.dumps({
-                        "type": "audio_result",
-                        "result": result,
-                        "behavior_score": behavior_scorer.get_current_score()
-                    }))
-                
-            elif message["type"] == "tab_switch":
-                # Handle tab switching violation
-                violation = behavior_scorer.add_tab_switch_violation()
-                await db_manager.log_violation(user_id, course_id, violation)
-                
-                await websocket.send_text(json.dumps({
-                    "type": "tab_switch_result",
-                    "behavior_score": behavior_scorer.get_current_score(),
-                    "violation": violation
-                }))
-                
+        await session.run()
+        
     except WebSocketDisconnect:
         logger.info(f"Proctoring session ended for user {user_id}")
     except Exception as e:
@@ -153,7 +116,7 @@ async def verify_identity(request: IdentityVerification):
             "message": "Identity verified successfully"
         }
         
-        return JSONResponse(result)
+        return ORJSONResponse(result)
         
     except Exception as e:
         logger.error(f"Error verifying identity: {e}")
@@ -174,7 +137,7 @@ async def submit_test(request: TestSubmission):
             "test_score": request.test_score,
             "behavior_score": final_score_result["behavior_score"],
             "final_score": final_score_result["final_score"],
-            "violations": behavior_scorer.violations,
+            "violations": [stored_violation(violation) for violation in behavior_scorer.violations],
             "certificate_status": final_score_result["certificate_status"],
             "submitted_at": datetime.utcnow()
         }
@@ -183,11 +146,11 @@ async def submit_test(request: TestSubmission):
         success = await db_manager.save_test_result(test_result)
         
         if success:
-            return JSONResponse({
+            return ORJSONResponse({
                 "success": True,
                 "final_score": final_score_result["final_score"],
                 "certificate_status": final_score_result["certificate_status"],
-                "violations_count": len(behavior_scorer.violations),
+                "violations_count": final_score_result["violation_summary"]["total_violations"],
                 "detailed_report": behavior_scorer.get_detailed_report()
             })
         else:
@@ -202,7 +165,7 @@ async def get_test_results(user_id: str):
     """Get test results for a user"""
     try:
         results = await db_manager.get_test_results(user_id)
-        return JSONResponse({"results": results})
+        return ORJSONResponse({"results": results})
     except Exception as e:
         logger.error(f"Error fetching test results: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -212,7 +175,7 @@ async def get_violations(user_id: str, course_id: str):
     """Get violations for a specific test session"""
     try:
         violations = await db_manager.get_violations(user_id, course_id)
-        return JSONResponse({"violations": violations})
+        return ORJSONResponse({"violations": violations})
     except Exception as e:
         logger.error(f"Error fetching violations: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -222,7 +185,7 @@ async def get_certificate_status(user_id: str, course_id: str):
     """Get certificate status for a user and course"""
     try:
         status = await db_manager.get_certificate_status(user_id, course_id)
-        return JSONResponse({"certificate_status": status})
+        return ORJSONResponse({"certificate_status": status})
     except Exception as e:
         logger.error(f"Error fetching certificate status: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -231,7 +194,7 @@ async def get_certificate_status(user_id: str, course_id: str):
 async def get_current_score():
     """Get current behavior score"""
     try:
-        return JSONResponse({
+        return ORJSONResponse({
             "behavior_score": behavior_scorer.get_current_score(),
             "violation_summary": behavior_scorer.get_violation_summary()
         })
@@ -241,4 +204,5 @@ async def get_current_score():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Multiple workers need an import string rather than the app object
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=int(os.getenv("WEB_CONCURRENCY", "1")))
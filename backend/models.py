@@ -23,10 +23,14 @@ class SeverityLevel(str, Enum):
     CRITICAL = "critical"
 
 class Violation(BaseModel):
+    # Mirrors the records stored by behavior_scorer.stored_violation
     type: ViolationType
     timestamp: datetime
     severity: SeverityLevel
-    db_level: Optional[float] = None
+    count: int
+    penalty_applied: bool
+    penalty_amount: Optional[int] = None
+    additional_data: Dict[str, Any] = {}
 
 class TestSubmission(BaseModel):
     user_id: str
@@ -0,0 +1,223 @@
+import asyncio
+import itertools
+import logging
+import time
+from collections import deque
+from concurrent.futures import Executor
+from typing import Dict, Any, Optional
+
+import orjson
+from fastapi import WebSocket
+
+from database import db_manager
+from video_processor import VideoProcessor, FrameBatcher
+from audio_processor import AudioProcessor, SpectralWindow
+from behavior_scorer import BehaviorScorer, reported_violation, stored_violation
+
+logger = logging.getLogger(__name__)
+
+# Binary websocket framing: one type byte followed by the raw payload
+FRAME_TYPE_VIDEO = 1  # JPEG image
+FRAME_TYPE_AUDIO = 2  # 16-bit PCM samples
+FRAME_TYPE_TAB = 3    # no payload
+
+DROP_REPORT_WINDOW = 30   # frames per drop-rate measurement (~1 s at 30 FPS)
+DROP_RATE_WARNING = 0.10  # log when more than this share of a window is dropped
+
+def dumps(payload: Dict[str, Any]) -> str:
+    """Serialize a websocket payload (datetimes and NumPy scalars included)"""
+    return orjson.dumps(payload, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+
+class ProctoringSession:
+    """Runs one proctoring websocket as a decode -> infer -> send pipeline"""
+    
+    def __init__(self, websocket: WebSocket, user_id: str, course_id: str,
+                 video_processor: Optional[VideoProcessor], frame_batcher: Optional[FrameBatcher],
+                 audio_processor: Optional[AudioProcessor], behavior_scorer: BehaviorScorer,
+                 cpu_pool: Optional[Executor] = None, prefetch: int = 4, infer_backlog: int = 2,
+                 violation_flush_interval: float = 0.25, debug: bool = False, trace: bool = False):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.course_id = course_id
+        self.video_processor = video_processor
+        self.frame_batcher = frame_batcher
+        self.audio_processor = audio_processor
+        self.behavior_scorer = behavior_scorer
+        self.cpu_pool = cpu_pool
+        self.debug = debug  # send face boxes and every frame's full result
+        self.trace = trace  # add each frame's receive-to-result latency_ms
+        self._spectral_window = SpectralWindow()  # this session's audio awaiting spectral analysis
+        
+        # Bounded queues between stages give back-pressure to the receive loop;
+        # the infer queue is lossy so a slow YOLO never builds up stale frames
+        self._decode_q = asyncio.Queue(maxsize=prefetch)
+        self._infer_q = asyncio.Queue(maxsize=infer_backlog)
+        self._send_q = asyncio.Queue(maxsize=prefetch)
+        self._frame_ids = itertools.count()
+        self._window_frames = 0
+        self._window_dropped = 0
+        
+        # Violations wait here and are written in bulk, off the per-frame path
+        self._violation_buffer = deque()
+        self.violation_flush_interval = violation_flush_interval
+        
+        # (face_count, face_stable, behavior_score) of the last video_result sent
+        self._last_video_state = None
+    
+    async def run(self):
+        """Receive messages until the client disconnects or any stage fails, then tear everything down"""
+        tasks = [
+            asyncio.create_task(self._receive_loop()),
+            asyncio.create_task(self._decode_stage()),
+            asyncio.create_task(self._infer_stage()),
+            asyncio.create_task(self._send_stage()),
+            asyncio.create_task(self._flusher())
+        ]
+        try:
+            # Every task loops forever, so the first one to finish has failed
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self._flush_violations()
+        
+        # Re-raise the failure (WebSocketDisconnect from the receive loop included)
+        for task in done:
+            task.result()
+    
+    async def _receive_loop(self):
+        """Read binary messages and dispatch them by type byte"""
+        while True:
+            message = await self.websocket.receive_bytes()
+            frame_type = message[0]
+            
+            if frame_type == FRAME_TYPE_VIDEO:
+                if self.video_processor:
+                    await self._decode_q.put((next(self._frame_ids), time.monotonic_ns(), memoryview(message)[1:]))
+            
+            elif frame_type == FRAME_TYPE_AUDIO:
+                # Process audio chunk
+                if self.audio_processor:
+                    # Copy the samples out so the int16 view starts on an aligned address
+                    audio_bytes = message[1:]
+                    result = await self.audio_processor.process_audio_chunk_async(audio_bytes, self.cpu_pool,
+                                                                             self._spectral_window)
+                    
+                    if result is not None:
+                        # Process violations
+                        violations = self.behavior_scorer.process_audio_analysis(result)
+                        
+                        self._violation_buffer.extend(violations)
+                    
+                    await self._send_q.put({
+                        "type": "audio_result",
+                        "result": result.to_dict() if result is not None else {"error": "Invalid audio data", "success": False},
+                        "behavior_score": self.behavior_scorer.get_current_score()
+                    })
+            
+            elif frame_type == FRAME_TYPE_TAB:
+                # Handle tab switching violation
+                violation = self.behavior_scorer.add_tab_switch_violation()
+                self._violation_buffer.append(violation)
+                
+                await self._send_q.put({
+                    "type": "tab_switch_result",
+                    "behavior_score": self.behavior_scorer.get_current_score(),
+                    "violation": reported_violation(violation)
+                })
+    
+    async def _decode_stage(self):
+        """Decode JPEG payloads on the CPU pool"""
+        loop = asyncio.get_running_loop()
+        
+        while True:
+            frame_id, received_ns, payload = await self._decode_q.get()
+            try:
+                frame = await loop.run_in_executor(self.cpu_pool, self.video_processor.decode_frame, payload)
+            except Exception as e:
+                logger.error(f"Error decoding frame {frame_id}: {e}")
+                frame = None
+            
+            # Keep the newest frame: evict the oldest one if YOLO is behind
+            try:
+                self._infer_q.put_nowait((frame_id, received_ns, frame))
+            except asyncio.QueueFull:
+                self._infer_q.get_nowait()
+                self._infer_q.put_nowait((frame_id, received_ns, frame))
+                self._window_dropped += 1
+            
+            self._window_frames += 1
+            if self._window_frames >= DROP_REPORT_WINDOW:
+                await self._report_drops()
+    
+    async def _report_drops(self):
+        """Report each window's dropped frames so the client can slow down, or speed back up after a clean window"""
+        frames, dropped = self._window_frames, self._window_dropped
+        self._window_frames = self._window_dropped = 0
+        
+        if dropped / frames > DROP_RATE_WARNING:
+            logger.warning(f"Dropped {dropped}/{frames} frames for user {self.user_id}; inference is falling behind")
+        
+        await self._send_q.put({"type": "frame_dropped", "dropped": dropped, "frames": frames})
+    
+    async def _infer_stage(self):
+        """Detect faces through the shared batcher and score the result"""
+        while True:
+            frame_id, received_ns, frame = await self._infer_q.get()
+            try:
+                if frame is None:
+                    result = {"error": "Invalid frame data"}
+                else:
+                    # YOLO runs on batches of frames gathered across sessions
+                    faces = await self.frame_batcher.detect(frame)
+                    result = self.video_processor.build_frame_result(frame, faces, debug=self.debug)
+                
+                if self.trace:
+                    result["latency_ms"] = (time.monotonic_ns() - received_ns) / 1e6
+                
+                if result.get("success", False):
+                    # Process violations
+                    violations = self.behavior_scorer.process_video_analysis(result)
+                    
+                    self._violation_buffer.extend(violations)
+                
+                behavior_score = self.behavior_scorer.get_current_score()
+                if not self.debug and result.get("success", False):
+                    # Unchanged frames only need a heartbeat
+                    state = (result["face_count"], result["face_stable"], behavior_score)
+                    if state == self._last_video_state:
+                        await self._send_q.put({"type": "ok"})
+                        continue
+                    self._last_video_state = state
+                
+                await self._send_q.put({
+                    "type": "video_result",
+                    "frame_id": frame_id,
+                    "result": result,
+                    "behavior_score": behavior_score
+                })
+            
+            except Exception as e:
+                logger.error(f"Error processing frame {frame_id}: {e}")
+    
+    async def _send_stage(self):
+        """Serialize and send responses in the order they were produced"""
+        while True:
+            payload = await self._send_q.get()
+            await self.websocket.send_text(dumps(payload))
+    
+    async def _flush_violations(self):
+        """Write everything currently buffered in one bulk insert"""
+        if not self._violation_buffer:
+            return
+        
+        violations = [stored_violation(violation) for violation in self._violation_buffer]
+        self._violation_buffer.clear()
+        await db_manager.log_violations_bulk(self.user_id, self.course_id, violations)
+    
+    async def _flusher(self):
+        """Flush buffered violations every violation_flush_interval seconds"""
+        while True:
+            await asyncio.sleep(self.violation_flush_interval)
+            await self._flush_violations()
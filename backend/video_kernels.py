@@ -0,0 +1,51 @@
+import numpy as np
+from numba import njit, prange
+from typing import Tuple
+
+HEAD_TURN_PX = 50          # horizontal center shift that counts as a head turn
+MOVEMENT_SCALE_PX = 100.0  # center shift that saturates the movement score (~640x480 frames)
+
+@njit(cache=True, fastmath=True)
+def movement_core(cx: int, cy: int, px: int, py: int) -> Tuple[float, bool, float]:
+    """Movement score, head-turn flag and face stability between two face centers"""
+    dx = cx - px
+    dy = cy - py
+
+    # Only take the square root when the score isn't already saturated at 1.0
+    dist_sq = dx * dx + dy * dy
+    if dist_sq >= MOVEMENT_SCALE_PX * MOVEMENT_SCALE_PX:
+        movement_score = 1.0
+    else:
+        movement_score = dist_sq ** 0.5 / MOVEMENT_SCALE_PX
+
+    return movement_score, abs(dx) > HEAD_TURN_PX, 1.0
+
+@njit(parallel=True, fastmath=True, cache=True)
+def preprocess_bgr(frames_u8: np.ndarray, out_f32: np.ndarray, pad_top: int):
+    """(B, H, W, 3) BGR uint8 frames -> (B, 3, H', W) RGB float32 in [0, 1]
+
+    Rows outside [pad_top, pad_top + H) are filled with the letterbox gray (114)
+    Ultralytics pads with, so H' can be rounded up to the model stride.
+    """
+    batch, height, width, _ = frames_u8.shape
+    out_height = out_f32.shape[2]
+    scale = np.float32(1.0 / 255.0)
+    pad_value = np.float32(114.0 / 255.0)
+
+    for i in prange(batch * out_height):
+        b = i // out_height
+        y = i % out_height
+        src_y = y - pad_top
+        if src_y < 0 or src_y >= height:
+            for c in range(3):
+                for x in range(width):
+                    out_f32[b, c, y, x] = pad_value
+        else:
+            for x in range(width):
+                for c in range(3):
+                    out_f32[b, c, y, x] = frames_u8[b, src_y, x, 2 - c] * scale
+
+# Compile for the int face centers and uint8 frames used by VideoProcessor at
+# import time, so the first frame of a session doesn't pay for JIT compilation
+movement_core(0, 0, 0, 0)
+preprocess_bgr(np.zeros((1, 2, 2, 3), np.uint8), np.empty((1, 3, 4, 2), np.float32), 1)
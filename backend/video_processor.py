@@ -1,74 +1,274 @@
 import cv2
 import numpy as np
-import base64
+import asyncio
+import itertools
 import logging
+import os
+import shutil
+import tempfile
+import threading
+import torch
 from ultralytics import YOLO
+from ultralytics.utils.downloads import attempt_download_asset
+from ultralytics.utils.ops import non_max_suppression
 from deepface import DeepFace
-import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Any, List, Tuple
+from video_kernels import movement_core, preprocess_bgr
+
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR
+except ImportError:  # PyTurboJPEG is optional; cv2.imdecode is the fallback
+    TurboJPEG = None
 
 logger = logging.getLogger(__name__)
 
+YOLO_WEIGHTS = 'yolov8n.pt'
+YOLO_INPUT_SIZE = (320, 240)  # (width, height) frames are resized to before detection
+YOLO_IMGSZ = 320  # model input size; a 320x240 frame fits without upscaling
+YOLO_MAX_BATCH = 8  # largest batch FrameBatcher sends, and the engine's batch profile
+YOLO_STRIDE = 32
+# The raw PyTorch path letterboxes the frame height up to a multiple of the stride
+YOLO_PAD_TOP = (-YOLO_INPUT_SIZE[1] % YOLO_STRIDE) // 2
+YOLO_PADDED_HEIGHT = YOLO_INPUT_SIZE[1] + (-YOLO_INPUT_SIZE[1] % YOLO_STRIDE)
+YOLO_CONF = 0.25  # Ultralytics predict() defaults
+YOLO_IOU = 0.7
+# "fp16", or "int8" for OpenVINO post-training quantization (CPU only) calibrated on YOLO_CALIBRATION_DATA
+YOLO_PRECISION = os.getenv("YOLO_PRECISION", "fp16").lower()
+YOLO_CALIBRATION_DATA = os.getenv("YOLO_CALIBRATION_DATA", "calib.yaml")  # dataset yaml, ~100 proctoring frames
+HAAR_FALLBACK_WARN_STREAK = 5  # consecutive Haar fallbacks before warning
+
+def _export_once(fmt: str, path: str, **kwargs) -> str:
+    """Export YOLO_WEIGHTS to path unless an earlier run already did"""
+    if os.path.exists(path):
+        return path
+    
+    # Workers starting together all export; each works on a private copy of the weights
+    # (Ultralytics writes its intermediate files next to them) and the finished export is
+    # renamed into place atomically, so path only ever holds a complete model
+    workdir = tempfile.mkdtemp(prefix=".yolo-export-", dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        weights = shutil.copy(attempt_download_asset(YOLO_WEIGHTS), workdir)
+        logger.info(f"Exporting {YOLO_WEIGHTS} to {fmt}, this can take a few minutes")
+        exported = YOLO(weights).export(format=fmt, imgsz=YOLO_IMGSZ, batch=YOLO_MAX_BATCH,
+                                        dynamic=True, **kwargs)
+        try:
+            os.replace(exported, path)
+        except OSError:
+            # A directory export (OpenVINO) can't replace one another worker already moved in
+            if not os.path.exists(path):
+                raise
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return path
+
+def _load_yolo_model() -> YOLO:
+    """Load YOLOv8 as an FP16 TensorRT engine on CUDA, an INT8 OpenVINO model on CPU if requested, else the PyTorch weights"""
+    int8 = YOLO_PRECISION == 'int8'
+    stem = f"{os.path.splitext(YOLO_WEIGHTS)[0]}-{YOLO_IMGSZ}-b{YOLO_MAX_BATCH}"
+    
+    if not torch.cuda.is_available():
+        if not int8:
+            return YOLO(YOLO_WEIGHTS)
+        try:
+            # INT8 OpenVINO runs on the CPU's VNNI dot-product instructions
+            path = _export_once('openvino', f"{stem}-int8_openvino_model", int8=True, data=YOLO_CALIBRATION_DATA)
+            return YOLO(path, task='detect')
+        except Exception as e:
+            logger.warning(f"OpenVINO INT8 model unavailable, using {YOLO_WEIGHTS}: {e}")
+            return YOLO(YOLO_WEIGHTS)
+    
+    # Let cuDNN pick the fastest conv kernels for our fixed NCHW input shape
+    torch.backends.cudnn.benchmark = True
+    
+    # Ultralytics 8.0.196 has no TensorRT INT8 calibration; it would silently build an FP32 engine
+    if int8:
+        logger.warning("YOLO_PRECISION=int8 is only supported on CPU (OpenVINO); using the FP16 TensorRT engine")
+    
+    try:
+        return YOLO(_export_once('engine', f"{stem}-fp16.engine", device=0, half=True), task='detect')
+    except Exception as e:
+        logger.warning(f"TensorRT engine unavailable, using {YOLO_WEIGHTS}: {e}")
+        return YOLO(YOLO_WEIGHTS)
+
 class VideoProcessor:
-    def __init__(self):
+    def __init__(self, yolo_service_address: str = None):
+        self.yolo_service_address = yolo_service_address  # "host:port" of a shared yolo_service
         self.yolo_model = None
+        self._yolo_client = None  # set when YOLO runs in the shared yolo_service process
+        self._torch_model = None  # the underlying nn.Module when running PyTorch weights
+        self._device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
         self.face_cascade = None
+        self._tj = None
+        self._haar_streak = 0  # consecutive frames that needed the Haar fallback
+        self._local = threading.local()  # per-thread resize and input buffers
         self._initialize_models()
     
     def _initialize_models(self):
         """Initialize computer vision models"""
+        # Initialize OpenCV face cascade first, so it is there whatever happens to YOLO
         try:
-            # Initialize YOLOv8 model
-            self.yolo_model = YOLO('yolov8n.pt')
-            logger.info("YOLOv8 model loaded successfully")
-            
-            # Initialize OpenCV face cascade
             self.face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
             logger.info("OpenCV face cascade loaded successfully")
-            
         except Exception as e:
-            logger.error(f"Error initializing video models: {e}")
+            logger.error(f"Error loading OpenCV face cascade: {e}")
+        
+        # A configured YOLO service that can't be used is a startup error, not a silent
+        # fallback: every frame would report no faces and penalize every candidate
+        if self.yolo_service_address:
+            from yolo_service import YoloClient
+            self._yolo_client = YoloClient(self.yolo_service_address)
+            logger.info(f"Using shared YOLO service at {self.yolo_service_address}")
+        else:
+            try:
+                # Initialize YOLOv8 model
+                self.yolo_model = _load_yolo_model()
+                if isinstance(self.yolo_model.model, torch.nn.Module):
+                    # PyTorch weights: call the network directly with our own preprocessing
+                    self._torch_model = self.yolo_model.model.fuse(verbose=False).to(self._device).eval()
+                logger.info("YOLOv8 model loaded successfully")
+            except Exception as e:
+                logger.error(f"Error initializing video models: {e}")
+        
+        # libjpeg-turbo decoder, when the library is installed
+        if TurboJPEG is not None:
+            try:
+                self._tj = TurboJPEG()
+            except Exception as e:
+                logger.warning(f"libturbojpeg unavailable, decoding frames with OpenCV: {e}")
     
-    def decode_frame(self, frame_data: str) -> np.ndarray:
-        """Decode base64 frame data to OpenCV image"""
+    def decode_frame(self, frame_data: bytes) -> np.ndarray:
+        """Decode JPEG frame bytes to OpenCV image"""
         try:
-            frame_bytes = base64.b64decode(frame_data)
-            nparr = np.frombuffer(frame_bytes, np.uint8)
+            if self._tj is not None:
+                return self._tj.decode(frame_data, pixel_format=TJPF_BGR)
+            
+            nparr = np.frombuffer(frame_data, np.uint8)
             frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
             return frame
         except Exception as e:
             logger.error(f"Error decoding frame: {e}")
             return None
     
+    def _resize_buffers(self) -> np.ndarray:
+        """This thread's preallocated (YOLO_MAX_BATCH, H, W, 3) resize destination"""
+        buffers = getattr(self._local, "resize_buffers", None)
+        if buffers is None:
+            width, height = YOLO_INPUT_SIZE
+            buffers = self._local.resize_buffers = np.empty((YOLO_MAX_BATCH, height, width, 3), np.uint8)
+        return buffers
+    
+    def _input_buffer(self) -> np.ndarray:
+        """This thread's preallocated (YOLO_MAX_BATCH, 3, H', W) float32 network input"""
+        buffer = getattr(self._local, "input_buffer", None)
+        if buffer is None:
+            buffer = self._local.input_buffer = np.empty(
+                (YOLO_MAX_BATCH, 3, YOLO_PADDED_HEIGHT, YOLO_INPUT_SIZE[0]), np.float32
+            )
+        return buffer
+    
+    def _resize_for_yolo(self, frame: np.ndarray, dst: np.ndarray) -> Tuple[float, float]:
+        """Downscale a frame into dst, returning the (x, y) factors back to full size"""
+        frame_height, frame_width = frame.shape[:2]
+        cv2.resize(frame, YOLO_INPUT_SIZE, dst=dst, interpolation=cv2.INTER_LINEAR)
+        return frame_width / YOLO_INPUT_SIZE[0], frame_height / YOLO_INPUT_SIZE[1]
+    
+    def _faces_from_xyxy(self, xyxy: np.ndarray, confs: np.ndarray,
+                         scale: Tuple[float, float] = (1.0, 1.0)) -> List[Dict[str, Any]]:
+        """Convert host-side boxes into face dicts, scaled back to the original frame"""
+        xyxy = xyxy * np.tile(scale, 2)
+        centers = (xyxy[:, :2] + xyxy[:, 2:]) / 2
+        
+        # Convert whole columns at once; tolist() yields plain Python ints and floats
+        return [
+            {"bbox": bbox, "confidence": confidence, "center": center}
+            for bbox, confidence, center in zip(xyxy.astype(np.int64).tolist(), confs.tolist(),
+                                                centers.astype(np.int64).tolist())
+        ]
+    
+    def _faces_from_result(self, result, scale: Tuple[float, float] = (1.0, 1.0)) -> List[Dict[str, Any]]:
+        """Convert one YOLO result into face dicts, with boxes scaled back to the original frame"""
+        boxes = result.boxes
+        if boxes is None or len(boxes) == 0:
+            return []
+        
+        # One device-to-host copy per result rather than per box
+        return self._faces_from_xyxy(boxes.xyxy.cpu().numpy(), boxes.conf.cpu().numpy(), scale)
+    
+    def _detect_raw(self, smalls: np.ndarray) -> List[np.ndarray]:
+        """Run the PyTorch network on (n, H, W, 3) resized frames, returning (k, 6) detections each"""
+        inputs = self._input_buffer()[:len(smalls)]
+        preprocess_bgr(smalls, inputs, YOLO_PAD_TOP)
+        
+        with torch.inference_mode():
+            preds = self._torch_model(torch.from_numpy(inputs).to(self._device, non_blocking=True))
+            detections = non_max_suppression(preds, conf_thres=YOLO_CONF, iou_thres=YOLO_IOU, classes=[0])
+        
+        # Undo the letterbox offset and clip to the resized frame
+        width, height = YOLO_INPUT_SIZE
+        host = []
+        for det in detections:
+            det = det.cpu().numpy()
+            det[:, [1, 3]] = np.clip(det[:, [1, 3]] - YOLO_PAD_TOP, 0, height)
+            det[:, [0, 2]] = np.clip(det[:, [0, 2]], 0, width)
+            host.append(det)
+        return host
+    
+    def detect_resized(self, smalls: np.ndarray, scales: List[Tuple[float, float]]) -> List[List[Dict[str, Any]]]:
+        """Detect people in (n, H, W, 3) frames already resized to YOLO_INPUT_SIZE"""
+        if self._torch_model is not None:
+            detections = self._detect_raw(smalls)
+            return [self._faces_from_xyxy(det[:, :4], det[:, 4], scale)
+                    for det, scale in zip(detections, scales)]
+        
+        # Ultralytics accepts a list of images and runs them as one batch
+        results = self.yolo_model(list(smalls), classes=[0], imgsz=YOLO_IMGSZ, verbose=False)
+        return [self._faces_from_result(result, scale) for result, scale in zip(results, scales)]
+    
     def detect_faces_yolo(self, frame: np.ndarray) -> List[Dict[str, Any]]:
         """Detect faces using YOLOv8"""
+        return self.detect_faces_yolo_batch([frame])[0]
+    
+    def detect_faces_yolo_batch(self, frames: List[np.ndarray]) -> List[List[Dict[str, Any]]]:
+        """Detect faces in several frames with a single YOLOv8 forward pass"""
         try:
+            # Shared YOLO service: resize straight into its shared memory
+            if self._yolo_client is not None:
+                with self._yolo_client.lock:
+                    scales = [self._resize_for_yolo(frame, self._yolo_client.frames[slot])
+                              for slot, frame in enumerate(frames)]
+                    return self._yolo_client.detect(len(frames), scales)
+            
             if self.yolo_model is None:
-                return []
+                return [[] for _ in frames]
             
-            # Run YOLOv8 detection for person class (class 0)
-            results = self.yolo_model(frame, classes=[0], verbose=False)
-            
-            faces = []
-            for result in results:
-                boxes = result.boxes
-                if boxes is not None:
-                    for box in boxes:
-                        # Get bounding box coordinates
-                        x1, y1, x2, y2 = box.xyxy[0].cpu().numpy()
-                        confidence = box.conf[0].cpu().numpy()
-                        
-                        faces.append({
-                            "bbox": [int(x1), int(y1), int(x2), int(y2)],
-                            "confidence": float(confidence),
-                            "center": [int((x1 + x2) / 2), int((y1 + y2) / 2)]
-                        })
-            
-            return faces
+            # Run detection for person class (class 0) on downscaled copies
+            smalls = self._resize_buffers()[:len(frames)]
+            scales = [self._resize_for_yolo(frame, small) for frame, small in zip(frames, smalls)]
+            return self.detect_resized(smalls, scales)
             
         except Exception as e:
             logger.error(f"Error detecting faces with YOLO: {e}")
-            return []
+            return [[] for _ in frames]
+    
+    def detect_faces_batch(self, frames: List[np.ndarray]) -> List[List[Dict[str, Any]]]:
+        """Batched YOLO detection, with the Haar cascade for each frame where YOLO finds nothing"""
+        # Batches mix sessions, so each frame falls back on its own
+        faces_per_frame = self.detect_faces_yolo_batch(frames)
+        for faces in faces_per_frame:
+            self._record_fallback(not faces)
+        return [faces or self.detect_faces_opencv(frame) for frame, faces in zip(frames, faces_per_frame)]
+    
+    def _record_fallback(self, used: bool):
+        """Track consecutive Haar fallbacks and warn once a streak gets long"""
+        if not used:
+            self._haar_streak = 0
+            return
+        
+        self._haar_streak += 1
+        if self._haar_streak == HAAR_FALLBACK_WARN_STREAK + 1:
+            logger.warning(f"YOLO found nobody in {self._haar_streak} consecutive frames, "
+                           f"falling back to Haar cascade (check camera and lighting)")
     
     def detect_faces_opencv(self, frame: np.ndarray) -> List[Dict[str, Any]]:
         """Detect faces using OpenCV Haar Cascade"""
@@ -76,11 +276,16 @@ class VideoProcessor:
             if self.face_cascade is None:
                 return []
             
+            # Half resolution is plenty for a fallback and quarters the cascade scan
             gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            faces = self.face_cascade.detectMultiScale(gray, 1.1, 4)
+            gray = cv2.resize(gray, None, fx=0.5, fy=0.5, interpolation=cv2.INTER_LINEAR)
+            faces = self.face_cascade.detectMultiScale(
+                gray, scaleFactor=1.2, minNeighbors=4, minSize=(30, 30), flags=cv2.CASCADE_SCALE_IMAGE
+            )
             
             face_data = []
             for (x, y, w, h) in faces:
+                x, y, w, h = 2 * int(x), 2 * int(y), 2 * int(w), 2 * int(h)
                 face_data.append({
                     "bbox": [x, y, x + w, y + h],
                     "confidence": 1.0,  # Haar cascade doesn't provide confidence
@@ -119,28 +324,21 @@ class VideoProcessor:
                 "face_stability": 1.0
             }
             
-            if not current_faces or not previous_faces:
+            # Same detections (or none) means no movement to measure
+            if not current_faces or not previous_faces or current_faces is previous_faces:
                 return movement_data
             
             # Calculate movement between face centers
             current_center = current_faces[0]["center"]
             previous_center = previous_faces[0]["center"]
-            
-            # Calculate distance moved
-            distance = np.sqrt(
-                (current_center[0] - previous_center[0])**2 + 
-                (current_center[1] - previous_center[1])**2
+            movement_score, head_turn, face_stability = movement_core(
+                int(current_center[0]), int(current_center[1]),
+                int(previous_center[0]), int(previous_center[1])
             )
             
-            # Normalize movement (assuming frame size ~640x480)
-            normalized_movement = distance / 100.0
-            
-            movement_data["movement_score"] = min(normalized_movement, 1.0)
-            
-            # Detect head turning (significant horizontal movement)
-            horizontal_movement = abs(current_center[0] - previous_center[0])
-            if horizontal_movement > 50:  # Threshold for head turn
-                movement_data["head_turn_detected"] = True
+            movement_data["movement_score"] = movement_score
+            movement_data["head_turn_detected"] = head_turn
+            movement_data["face_stability"] = face_stability
             
             return movement_data
             
@@ -148,54 +346,145 @@ class VideoProcessor:
             logger.error(f"Error analyzing movement: {e}")
             return {"head_turn_detected": False, "movement_score": 0.0, "face_stability": 1.0}
     
-    def process_frame(self, frame_data: str, previous_faces: List[Dict] = None) -> Dict[str, Any]:
-        """Process a single video frame for proctoring analysis"""
+    def build_frame_result(self, frame: np.ndarray, faces: List[Dict[str, Any]],
+                           previous_faces: List[Dict] = None, debug: bool = False) -> Dict[str, Any]:
+        """Build the proctoring analysis for a frame; boxes and frame size only in debug mode"""
         try:
-            # Decode frame
-            frame = self.decode_frame(frame_data)
-            if frame is None:
-                return {"error": "Invalid frame data"}
-            
-            # Detect faces using both methods
-            yolo_faces = self.detect_faces_yolo(frame)
-            opencv_faces = self.detect_faces_opencv(frame)
-            
-            # Use YOLO results as primary, fallback to OpenCV
-            faces = yolo_faces if yolo_faces else opencv_faces
-            
             # Analyze movement if previous frame data is available
             movement_analysis = {}
             if previous_faces is not None:
                 movement_analysis = self.analyze_movement(faces, previous_faces)
             
-            # Calculate frame metrics
-            frame_height, frame_width = frame.shape[:2]
             face_count = len(faces)
-            
-            # Determine if face is present and stable
-            face_present = face_count > 0
-            face_stable = face_count == 1
-            
             result = {
                 "face_count": face_count,
-                "face_present": face_present,
-                "face_stable": face_stable,
-                "faces": faces,
-                "frame_dimensions": [frame_width, frame_height],
+                "face_present": face_count > 0,
+                "face_stable": face_count == 1,
                 "movement_analysis": movement_analysis,
-                "processing_time": time.time(),
                 "success": True
             }
             
+            if debug:
+                frame_height, frame_width = frame.shape[:2]
+                result["faces"] = faces
+                result["frame_dimensions"] = [frame_width, frame_height]
+            
             return result
             
         except Exception as e:
             logger.error(f"Error processing frame: {e}")
             return {"error": str(e), "success": False}
     
+    def process_frame(self, frame_data: bytes, previous_faces: List[Dict] = None,
+                      debug: bool = False) -> Dict[str, Any]:
+        """Process a single video frame for proctoring analysis"""
+        try:
+            # Decode frame
+            frame = self.decode_frame(frame_data)
+            if frame is None:
+                return {"error": "Invalid frame data"}
+            
+            # Same path as FrameBatcher: YOLO, then OpenCV only when YOLO finds nothing
+            faces = self.detect_faces_batch([frame])[0]
+            
+            return self.build_frame_result(frame, faces, previous_faces, debug)
+            
+        except Exception as e:
+            logger.error(f"Error processing frame: {e}")
+            return {"error": str(e), "success": False}
+    
     def cleanup(self):
         """Cleanup resources"""
+        if self._yolo_client:
+            self._yolo_client.close()
         if self.yolo_model:
             del self.yolo_model
         if self.face_cascade:
             del self.face_cascade
+
+
+class FrameBatcher:
+    """Coalesces frames from all websocket sessions into batched YOLO calls"""
+    
+    def __init__(self, video_processor: VideoProcessor, max_batch: int = YOLO_MAX_BATCH,
+                 max_wait_ms: float = 10.0, max_pending: int = 64):
+        self.video_processor = video_processor
+        self.max_batch = min(max_batch, YOLO_MAX_BATCH)  # resize buffers and engine profile stop here
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_pending = max_pending
+        self._next_id = itertools.count()
+        self._pending: Dict[int, asyncio.Future] = {}  # correlation id -> caller's future
+        # One thread owns the GPU so batches never contend for it
+        self._gpu_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="yolo")
+        # Created on first use so they bind to the running event loop
+        self._queue = None
+        self._batch_full = None
+        self._worker = None
+    
+    def _start(self):
+        """Create the frame queue and the background flush task"""
+        self._queue = asyncio.Queue(maxsize=self.max_pending)
+        self._batch_full = asyncio.Event()
+        self._worker = asyncio.create_task(self._run())
+    
+    async def detect(self, frame: np.ndarray) -> List[Dict[str, Any]]:
+        """Queue a decoded frame and wait for its faces from the next batch"""
+        if self._worker is None:
+            self._start()
+        
+        frame_id = next(self._next_id)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[frame_id] = future
+        
+        await self._queue.put((frame_id, frame))
+        if self._queue.qsize() >= self.max_batch - 1:
+            self._batch_full.set()
+        
+        return await future
+    
+    async def _run(self):
+        """Flush a batch every max_batch frames or max_wait seconds, whichever comes first"""
+        while True:
+            batch = [await self._queue.get()]
+            
+            # Wait for the batch to fill up, but never longer than max_wait
+            self._batch_full.clear()
+            if self._queue.qsize() < self.max_batch - 1:
+                try:
+                    await asyncio.wait_for(self._batch_full.wait(), self.max_wait)
+                except asyncio.TimeoutError:
+                    pass
+            
+            for _ in range(min(self._queue.qsize(), self.max_batch - 1)):
+                batch.append(self._queue.get_nowait())
+            
+            frame_ids, frames = zip(*batch)
+            try:
+                faces_per_frame = await asyncio.get_running_loop().run_in_executor(
+                    self._gpu_pool, self.video_processor.detect_faces_batch, list(frames)
+                )
+            except Exception as e:
+                logger.error(f"Error running batched face detection: {e}")
+                faces_per_frame = [[] for _ in frames]
+            
+            # Route each frame's faces back to its caller
+            for frame_id, faces in zip(frame_ids, faces_per_frame):
+                future = self._pending.pop(frame_id, None)
+                if future is not None and not future.done():
+                    future.set_result(faces)
+    
+    async def close(self):
+        """Stop the flush task and fail any frames still waiting"""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        
+        for future in self._pending.values():
+            if not future.done():
+                future.cancel()
+        self._pending.clear()
+        self._gpu_pool.shutdown(wait=False)
@@ -0,0 +1,103 @@
+import logging
+import os
+import threading
+from multiprocessing import resource_tracker
+from multiprocessing.managers import BaseManager
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, Any, List, Tuple
+
+import numpy as np
+
+from video_processor import VideoProcessor, YOLO_INPUT_SIZE, YOLO_MAX_BATCH
+
+logger = logging.getLogger(__name__)
+
+# Every client's shared frame block holds one full batch of resized frames
+FRAME_BATCH_SHAPE = (YOLO_MAX_BATCH, YOLO_INPUT_SIZE[1], YOLO_INPUT_SIZE[0], 3)
+
+def _authkey() -> bytes:
+    """The shared secret from YOLO_SERVICE_AUTHKEY; there is deliberately no default"""
+    # The manager connection unpickles what peers send, so it must never run on a known key
+    authkey = os.getenv("YOLO_SERVICE_AUTHKEY")
+    if not authkey:
+        raise RuntimeError("YOLO_SERVICE_AUTHKEY must be set to use the YOLO service")
+    return authkey.encode()
+
+def _parse_address(address: str) -> Tuple[str, int]:
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+class YoloServiceManager(BaseManager):
+    pass
+
+# Clients only need the type id; serve() registers the real factory
+YoloServiceManager.register("YoloService")
+
+class YoloService:
+    """Holds the one YOLO model on the GPU and serves every uvicorn worker"""
+    
+    def __init__(self):
+        self.video_processor = VideoProcessor()  # no service address: loads the model here
+        self._lock = threading.Lock()  # the manager serves each client on its own thread
+        self._frames: Dict[str, Tuple[SharedMemory, np.ndarray]] = {}
+    
+    def _attach(self, shm_name: str) -> np.ndarray:
+        """Map a client's shared frame block, once per client"""
+        if shm_name not in self._frames:
+            shm = SharedMemory(name=shm_name)
+            # The client owns the block; don't let this process's tracker unlink it
+            resource_tracker.unregister(shm._name, "shared_memory")
+            self._frames[shm_name] = (shm, np.ndarray(FRAME_BATCH_SHAPE, np.uint8, buffer=shm.buf))
+        return self._frames[shm_name][1]
+    
+    def release(self, shm_name: str):
+        """Forget a client's shared frame block"""
+        with self._lock:
+            entry = self._frames.pop(shm_name, None)
+        if entry is not None:
+            entry[0].close()
+    
+    def detect(self, shm_name: str, n_frames: int, scales: List[Tuple[float, float]]) -> List[List[Dict[str, Any]]]:
+        """Detect people in the first n_frames of a client's shared frame block"""
+        with self._lock:
+            frames = self._attach(shm_name)
+            return self.video_processor.detect_resized(frames[:n_frames], scales)
+
+class YoloClient:
+    """Runs YOLO in the shared service process; frames travel through shared memory"""
+    
+    def __init__(self, address: str):
+        manager = YoloServiceManager(address=_parse_address(address), authkey=_authkey())
+        manager.connect()
+        self._service = manager.YoloService()
+        
+        self._shm = SharedMemory(create=True, size=int(np.prod(FRAME_BATCH_SHAPE)))
+        self.frames = np.ndarray(FRAME_BATCH_SHAPE, np.uint8, buffer=self._shm.buf)
+        self.lock = threading.Lock()  # guards self.frames between resize and detect
+    
+    def detect(self, n_frames: int, scales: List[Tuple[float, float]]) -> List[List[Dict[str, Any]]]:
+        """Detect people in the first n_frames of self.frames"""
+        return self._service.detect(self._shm.name, n_frames, scales)
+    
+    def close(self):
+        """Release the shared frame block"""
+        try:
+            self._service.release(self._shm.name)
+        except Exception as e:
+            logger.warning(f"Error releasing YOLO service frames: {e}")
+        self._shm.close()
+        self._shm.unlink()
+
+def serve(address: str):
+    """Load YOLO once and serve detections to all workers until interrupted"""
+    authkey = _authkey()
+    service = YoloService()
+    YoloServiceManager.register("YoloService", callable=lambda: service)
+    
+    manager = YoloServiceManager(address=_parse_address(address), authkey=authkey)
+    logger.info(f"YOLO service listening on {address}")
+    manager.get_server().serve_forever()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    serve(os.getenv("YOLO_SERVICE_ADDRESS", "127.0.0.1:50055"))
@@ -1,6 +1,14 @@
 import React, { useState, useEffect, useRef, useCallback } from 'react';
 import { AlertTriangle, Camera, Mic, MicOff, CameraOff, Eye, EyeOff, Shield, CheckCircle, XCircle } from 'lucide-react';
 
+// Binary websocket framing: one type byte followed by the raw payload
+const FRAME_TYPE_VIDEO = 1; // JPEG image
+const FRAME_TYPE_AUDIO = 2; // 16-bit PCM samples
+const FRAME_TYPE_TAB = 3;   // no payload
+
+const INITIAL_FRAME_INTERVAL_MS = 1000 / 30; // 30 FPS
+const MAX_FRAME_INTERVAL_MS = 1000 / 10;     // never slow below 10 FPS
+
 interface ProctoringData {
   behaviorScore: number;
   violations: any[];
@@ -40,6 +48,7 @@ const ProctoringComponent: React.FC<ProctoringComponentProps> = ({
   const mediaStreamRef = useRef<MediaStream | null>(null);
   const websocketRef = useRef<WebSocket | null>(null);
   const intervalRef = useRef<NodeJS.Timeout | null>(null);
+  const frameIntervalRef = useRef(INITIAL_FRAME_INTERVAL_MS);
   const audioIntervalRef = useRef<NodeJS.Timeout | null>(null);
 
   // Initialize media devices
@@ -91,6 +100,11 @@ const ProctoringComponent: React.FC<ProctoringComponentProps> = ({
     ws.onmessage = (event) => {
       const data = JSON.parse(event.data);
       
+      if (data.type === 'ok') {
+        // Heartbeat: the last video_result still holds
+        return;
+      }
+      
       if (data.type === 'video_result') {
         setProctoringData(prev => ({
           ...prev,
@@ -109,6 +123,17 @@ const ProctoringComponent: React.FC<ProctoringComponentProps> = ({
           behaviorScore: data.behavior_score
         }));
         setWarnings(prev => [...prev, 'Tab switching detected - penalty applied']);
+      } else if (data.type === 'frame_dropped') {
+        // Capture less often while the server drops frames, and step back toward
+        // the initial rate after each window it keeps up with
+        const interval = data.dropped > 0
+          ? Math.min(frameIntervalRef.current * 1.5, MAX_FRAME_INTERVAL_MS)
+          : Math.max(frameIntervalRef.current / 1.5, INITIAL_FRAME_INTERVAL_MS);
+        if (intervalRef.current && interval !== frameIntervalRef.current) {
+          frameIntervalRef.current = interval;
+          clearInterval(intervalRef.current);
+          intervalRef.current = setInterval(captureVideoFrame, frameIntervalRef.current);
+        }
       }
     };
 
@@ -139,12 +164,11 @@ const ProctoringComponent: React.FC<ProctoringComponentProps> = ({
     canvas.height = video.videoHeight;
     ctx.drawImage(video, 0, 0);
 
-    const frameData = canvas.toDataURL('image/jpeg', 0.8).split(',')[1];
-    
-    websocketRef.current.send(JSON.stringify({
-      type: 'video_frame',
-      data: frameData
-    }));
+    canvas.toBlob((blob) => {
+      if (blob) {
+        websocketRef.current?.send(new Blob([new Uint8Array([FRAME_TYPE_VIDEO]), blob]));
+      }
+    }, 'image/jpeg', 0.8);
   }, []);
 
   // Capture and send audio chunks
@@ -165,13 +189,7 @@ const ProctoringComponent: React.FC<ProctoringComponentProps> = ({
           int16Array[i] = Math.max(-32768, Math.min(32767, inputData[i] * 32768));
         }
 
-        // Convert to base64
-        const audioData = btoa(String.fromCharCode(...new Uint8Array(int16Array.buffer)));
-        
-        websocketRef.current?.send(JSON.stringify({
-          type: 'audio_chunk',
-          data: audioData
-        }));
+        websocketRef.current?.send(new Blob([new Uint8Array([FRAME_TYPE_AUDIO]), int16Array]));
       };
 
       source.connect(processor);
@@ -185,9 +203,7 @@ const ProctoringComponent: React.FC<ProctoringComponentProps> = ({
   useEffect(() => {
     const handleVisibilityChange = () => {
       if (document.hidden && websocketRef.current) {
-        websocketRef.current.send(JSON.stringify({
-          type: 'tab_switch'
-        }));
+        websocketRef.current.send(new Uint8Array([FRAME_TYPE_TAB]));
       }
     };
 
@@ -212,7 +228,8 @@ const ProctoringComponent: React.FC<ProctoringComponentProps> = ({
       connectWebSocket();
       
       // Start capturing video frames (30 FPS)
-      intervalRef.current = setInterval(captureVideoFrame, 1000 / 30);
+      frameIntervalRef.current = INITIAL_FRAME_INTERVAL_MS;
+      intervalRef.current = setInterval(captureVideoFrame, frameIntervalRef.current);
       
       // Start capturing audio chunks (every 200ms)
       audioIntervalRef.current = setInterval(captureAudioChunk, 200);